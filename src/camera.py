@@ -4,7 +4,7 @@ CAPTURE_MODES = ["raw", "video"]  # Per-camera: "raw", "jpg", or "video" (len=nu
 VIDEO_OUTPUT_DIR = "/data/captures/videos"  # Where to store video files
 
 from time import time
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
 import numpy as np
 
 # Camera model configuration dictionaries
@@ -16,6 +16,7 @@ CAMERA_CONFIGS = {
         'gain_max': 16.0,
         'default_exposure': 10000,  # microseconds
         'supports_auto_exposure': False,
+        'mono': True,  # Reports a Bayer format but has no colour filter array
         'sensor_resolution': (1600, 1400),
         'description': 'PiVariety 2.2MP Global Shutter Mono',
         'white_level_preview': 255,  # For preview frames (8-bit)
@@ -28,6 +29,7 @@ CAMERA_CONFIGS = {
         'gain_max': 16.0,
         'default_exposure': 10000,  # microseconds
         'supports_auto_exposure': True,
+        'mono': False,
         'sensor_resolution': (4656, 3496),
         'description': 'IMX519 16MP Color',
         'white_level_preview': 255,  # For preview frames (8-bit)
@@ -44,9 +46,12 @@ camera_configurations = [
 class CameraManager:
 
 
-    def __init__(self, camera_indices=[0, 1], exposure_mode="auto", gain=None, exposure_time=None):
+    def __init__(self, camera_indices=[0, 1], exposure_mode="auto", gain=None, exposure_time=None, preview_raw=False,
+                 preview_min_fps=30):
         import time
         self.cameras = []
+        self.preview_raw = preview_raw  # Also stream raw in preview mode (for focus magnification)
+        self.last_crop_ms = 0.0  # Time spent extracting the last raw preview crop
         self.exposure_mode = exposure_mode
         self.gain = gain  # User-provided gain value (float, e.g., 1.0, 2.0, ...)
         self.exposure_time = exposure_time  # User-provided exposure time in microseconds
@@ -55,6 +60,11 @@ class CameraManager:
         self.still_configs = []
         self.last_gain = [gain or 1.0 for _ in camera_indices]  # Track last gain per camera
         self.last_exposure = [exposure_time or 10000 for _ in camera_indices]  # Track last exposure time per camera
+        # Track whether AE is running per camera (libcamera enables it by default where supported)
+        self.ae_enabled = [
+            (camera_configurations[idx] if idx < len(camera_configurations) else {}).get('supports_auto_exposure', False)
+            for idx in camera_indices
+        ]
 
         for idx in camera_indices:
             try:
@@ -64,8 +74,14 @@ class CameraManager:
                 config = camera_configurations[idx] if idx < len(camera_configurations) else {}
                 # Create both video (for preview) and still (for capture) configurations
                 sensor_res = cam.sensor_resolution
-                cam.video_configuration = cam.create_video_configuration(main={'size': (240, 240), 'format': 'RGB888'}, raw=None)
-                cam.still_configuration = cam.create_still_configuration(raw={'size': sensor_res, 'format': config.get('raw_format', 'SRGGB12')})
+                preview_raw_config = None
+                if preview_raw:
+                    preview_raw_config = {'size': self._preview_raw_size(cam, preview_min_fps),
+                                          'format': config.get('raw_format', 'SRGGB12')}
+                    print(f"[INFO] Preview raw stream: {preview_raw_config['size']}")
+                cam.video_configuration = cam.create_video_configuration(main={'size': (240, 240), 'format': 'RGB888'}, raw=preview_raw_config)
+                # Still mode defaults to a single buffer; bracketing needs several in flight to pipeline controls
+                cam.still_configuration = cam.create_still_configuration(raw={'size': sensor_res, 'format': config.get('raw_format', 'SRGGB12')}, buffer_count=3)
                 # Only specify 'main' stream for preview, no 'raw' stream
                 # preview_config = cam.create_video_configuration(main={'size': (240, 240), 'format': 'RGB888'}, controls={"FrameDurationLimits": (10000, 33333), "AnalogueGain": 14.0, "ExposureTime": 23123}, raw=None)
                 # still_config = cam.create_still_configuration(raw={'size': sensor_res, 'format': config.get('raw_format', 'SRGGB12')}, controls={"AnalogueGain": 14.0, "ExposureTime": 23123})
@@ -98,6 +114,28 @@ class CameraManager:
         except Exception as e:
             print(f"[ERROR] Could not print camera specs: {e}")
 
+    def _preview_raw_size(self, cam, min_fps):
+        """
+        Pick the raw size for the preview stream: the largest sensor mode that still runs at
+        min_fps, so adding the raw stream doesn't drop the sensor into a slow full-res mode.
+        On sensors whose only fast modes are binned the magnified crop is binned too; if no
+        mode reaches min_fps the fastest one is used and the preview runs at that rate.
+        """
+        try:
+            modes = cam.sensor_modes
+        except Exception as e:
+            print(f"[WARN] Could not list sensor modes: {e}")
+            return cam.sensor_resolution
+        fast = [m for m in modes if m.get('fps', 0) >= min_fps]
+        if fast:
+            mode = max(fast, key=lambda m: m['size'][0] * m['size'][1])
+        elif modes:
+            mode = max(modes, key=lambda m: m.get('fps', 0))
+            print(f"[WARN] No sensor mode reaches {min_fps} fps; preview limited to {mode.get('fps', 0):.1f} fps")
+        else:
+            return cam.sensor_resolution
+        return mode['size']
+
     def _should_use_custom_exposure(self, camera_index):
         """Determine if custom exposure correction should be used."""
         config = camera_configurations[camera_index] if camera_index < len(camera_configurations) else {}
@@ -117,6 +155,7 @@ class CameraManager:
         self.last_gain[cam_id] = gain  # Track last gain per camera
         self.last_exposure[cam_id] = exposure  # Track last exposure time
         ae_modes = ["gain-priority", "etime-priority", "auto"]
+        self.ae_enabled[cam_id] = self.exposure_mode in ae_modes and supports_ae
         if self.exposure_mode in ae_modes and supports_ae:
             if self.exposure_mode == "gain-priority":
                 print(f"[INFO] Setting GAIN-PRIORITY mode: Gain={gain}")
@@ -246,6 +285,15 @@ class CameraManager:
         #         self._apply_exposure_correction(cam_id, correction_stops)
         return 0
 
+    def _raw_to_uint16(self, arr):
+        """Convert a packed uint8 (height, width*2) raw array to uint16 (height, width)."""
+        if arr.dtype == np.uint8 and arr.shape[1] % 2 == 0:
+            height, width2 = arr.shape
+            width = width2 // 2
+            arr = arr.view(np.uint16).reshape(height, width)
+        # If already uint16 (or an unexpected layout), use as-is
+        return arr
+
     def capture_frame(self, cam_id=0, raw=False, jpg=False):
         """
         Capture a frame from the specified camera.
@@ -269,17 +317,7 @@ class CameraManager:
                     t1 = time.time()
                     print(f"[DEBUG] Raw array shape: {arr.shape}, dtype: {arr.dtype}")
                     print(f"[PROFILE] cam.capture_array('raw') took {(t1-t0)*1000:.2f} ms")
-                    # Convert packed uint8 (height, width*2) to uint16 (height, width)
-                    if arr.dtype == np.uint8 and arr.shape[1] % 2 == 0:
-                        height, width2 = arr.shape
-                        width = width2 // 2
-                        arr16 = arr.view(np.uint16).reshape(height, width)
-                        arr = arr16
-                    # If already uint16, just use as-is
-                    if arr.dtype == np.uint16:
-                        arr16 = arr
-                    else:
-                        arr16 = arr  # fallback for debugging
+                    arr16 = self._raw_to_uint16(arr)
                     # Smart AE: only for raw
                     self._maybe_correct_exposure(cam_id, False, arr16)
                     t2 = time.time()
@@ -311,6 +349,180 @@ class CameraManager:
         print(f"[ERROR] Camera id {cam_id} out of range.")
         return None
 
+    def capture_preview_with_crop(self, cam_id=0, crop_size=240):
+        """
+        Capture a preview frame plus a 1:1 centre crop of the raw stream from the same request.
+        Requires preview_raw=True; otherwise the crop is None.
+        The crop is sliced straight from the mapped raw buffer, so only crop_size^2 pixels are copied.
+        On colour sensors a single Bayer plane is returned (a 2*crop_size region sampled
+        every other pixel) so the CFA checkerboard doesn't read as detail.
+        The time spent on the crop is stored in last_crop_ms.
+        Returns (main_frame, raw_crop) or (None, None) on failure.
+        """
+        import time
+        if cam_id < len(self.cameras):
+            cam = self.cameras[cam_id]
+            config = camera_configurations[cam_id] if cam_id < len(camera_configurations) else {}
+            try:
+                req = cam.capture_request()
+                try:
+                    arr = req.make_array("main")
+                    crop = None
+                    if self.preview_raw:
+                        t0 = time.perf_counter()
+                        mono = config.get('mono', False)
+                        size = crop_size if mono else crop_size * 2
+                        with MappedArray(req, "raw") as m:
+                            buf = m.array  # uint8 (height, stride), 2 bytes per pixel
+                            # Stride may include padding; take the width from the configured stream
+                            w, h = cam.camera_configuration()["raw"]["size"]
+                            # Keep the origin on even coordinates so the Bayer phase is fixed
+                            y0 = max(0, (h - size) // 2) & ~1
+                            x0 = max(0, (w - size) // 2) & ~1
+                            # (rows, cols, 2 bytes) view of the region, no copy yet
+                            pixels = buf[y0:y0 + size, 2 * x0:2 * (x0 + size)].reshape(-1, size, 2)
+                            if not mono:
+                                pixels = pixels[::2, ::2]
+                            crop = np.ascontiguousarray(pixels).view(np.uint16)[..., 0]
+                        self.last_crop_ms = (time.perf_counter() - t0) * 1000
+                finally:
+                    req.release()
+                return arr, crop
+            except Exception as e:
+                print(f"[WARN] Failed to capture preview crop from camera {cam_id}: {e}")
+                return None, None
+        print(f"[ERROR] Camera id {cam_id} out of range.")
+        return None, None
+
+    def _bracket_matches(self, metadata, gain, exposure_time, tolerance, exposure_floor_us):
+        """Check whether a request's metadata shows the given gain/exposure was applied.
+        Exposure is quantized to sensor line time and gain to the sensor's gain steps,
+        so values are compared with a relative tolerance. Exposure also gets an absolute
+        floor of about one line time, since rounding dominates for short exposures.
+        """
+        applied_gain = metadata.get("AnalogueGain")
+        applied_exposure = metadata.get("ExposureTime")
+        if gain is not None:
+            if applied_gain is None or abs(applied_gain - gain) > gain * tolerance:
+                return False
+        if exposure_time is not None:
+            if applied_exposure is None or abs(applied_exposure - exposure_time) > max(exposure_time * tolerance, exposure_floor_us):
+                return False
+        return True
+
+    def _bracket_controls(self, step, supports_ae):
+        exposure_time, gain = step
+        controls = {}
+        if supports_ae:
+            controls["AeEnable"] = False
+        if gain is not None:
+            controls["AnalogueGain"] = gain
+        if exposure_time is not None:
+            controls["ExposureTime"] = exposure_time
+        return controls
+
+    def capture_bracket(self, brackets, cam_id=0, raw=True, tolerance=0.05, exposure_floor_us=50,
+                        settle_frames=1, max_frames=None):
+        """
+        Capture an exposure bracket with per-frame control pipelining.
+        brackets is a list of (exposure_time_us, gain) tuples; either may be None to leave it unchanged.
+        Controls for the next bracket step are queued on every frame, so the sensor pipeline
+        stays full instead of waiting for each setting to settle before sending the next.
+        Once every step is queued, the oldest unmatched step is queued again on each frame,
+        so a step whose frame was dropped is retried instead of lost.
+        Each returned frame is matched to a bracket step from its request metadata. A step only
+        matches frames returned more than settle_frames after it was queued (the next request
+        is already in flight and cannot carry the new controls), and a step whose settings equal
+        the pre-bracket ones only matches once the previous step has landed. Frames captured
+        while controls are still settling match no pending step and are discarded.
+        Returns a list (same order as brackets) of (array, metadata) tuples, or None for steps
+        that never settled within max_frames. Metadata holds the ExposureTime/AnalogueGain
+        actually applied to that frame. AE state and exposure in effect before the bracket are restored.
+        """
+        import time
+        if cam_id >= len(self.cameras):
+            print(f"[ERROR] Camera id {cam_id} out of range.")
+            return None
+        cam = self.cameras[cam_id]
+        config = camera_configurations[cam_id] if cam_id < len(camera_configurations) else {}
+        if max_frames is None:
+            # Controls take a few frames to reach the sensor; allow slack for each step
+            max_frames = len(brackets) * 6
+        supports_ae = config.get('supports_auto_exposure', False)
+        prev_ae = self.ae_enabled[cam_id]
+        try:
+            prev_metadata = cam.capture_metadata()
+        except Exception as e:
+            print(f"[WARN] Could not read pre-bracket metadata from camera {cam_id}: {e}")
+            prev_metadata = {}
+        prev_gain = prev_metadata.get("AnalogueGain", self.last_gain[cam_id])
+        prev_exposure = prev_metadata.get("ExposureTime", self.last_exposure[cam_id])
+        prev_settings = (prev_exposure, prev_gain)
+        results = [None] * len(brackets)
+        queued_at = []  # Frames returned before each step was first queued
+        queued = 0
+        frames = 0
+        discarded = 0
+        t0 = time.time()
+        try:
+            while frames < max_frames and any(r is None for r in results):
+                if queued < len(brackets):
+                    cam.set_controls(self._bracket_controls(brackets[queued], supports_ae))
+                    queued_at.append(frames)
+                    queued += 1
+                else:
+                    # Everything is queued; retry the oldest step still missing in case its frame was dropped
+                    oldest = next(i for i, r in enumerate(results) if r is None)
+                    cam.set_controls(self._bracket_controls(brackets[oldest], supports_ae))
+                req = cam.capture_request()
+                frames += 1
+                try:
+                    metadata = req.get_metadata()
+                    for i in range(queued):
+                        if results[i] is not None or frames <= queued_at[i] + settle_frames:
+                            continue
+                        exposure_time, gain = brackets[i]
+                        if i > 0 and results[i - 1] is None and \
+                                self._bracket_matches({"ExposureTime": prev_settings[0], "AnalogueGain": prev_settings[1]},
+                                                      gain, exposure_time, tolerance, exposure_floor_us):
+                            # Indistinguishable from a stale pre-bracket frame until the previous step has landed
+                            continue
+                        if self._bracket_matches(metadata, gain, exposure_time, tolerance, exposure_floor_us):
+                            arr = req.make_array("raw" if raw else "main")
+                            if raw:
+                                arr = self._raw_to_uint16(arr)
+                            applied = {
+                                "ExposureTime": metadata.get("ExposureTime"),
+                                "AnalogueGain": metadata.get("AnalogueGain"),
+                                "SensorTimestamp": metadata.get("SensorTimestamp"),
+                                "FrameDuration": metadata.get("FrameDuration"),
+                            }
+                            results[i] = (arr, applied)
+                            print(f"[BRACKET] Step {i}: Gain={applied['AnalogueGain']}, Exposure={applied['ExposureTime']}us (frame {frames})")
+                            break
+                    else:
+                        discarded += 1
+                finally:
+                    req.release()
+        except Exception as e:
+            print(f"[WARN] Bracket capture failed on camera {cam_id}: {e}")
+        finally:
+            # Restore the settings in use before the bracket
+            if supports_ae and prev_ae:
+                # Hand control back to AE; fixing ExposureTime/AnalogueGain here would pin them
+                cam.set_controls({"AeEnable": True})
+                self.last_gain[cam_id] = prev_gain
+                self.last_exposure[cam_id] = prev_exposure
+                print(f"[BRACKET] Restored AE (was Gain={prev_gain}, Exposure={prev_exposure}us)")
+            else:
+                self.set_exposure(cam_id, gain=prev_gain, exposure_time=prev_exposure)
+        t1 = time.time()
+        missing = sum(1 for r in results if r is None)
+        if missing:
+            print(f"[WARN] {missing} bracket step(s) did not settle within {max_frames} frames.")
+        print(f"[PROFILE] Bracket of {len(brackets)} took {frames} frames ({discarded} discarded) in {(t1-t0)*1000:.2f} ms")
+        return results
+
 
     def release(self):
         for i, cam in enumerate(self.cameras):
@@ -1,6 +1,6 @@
 from camera import CameraManager
 from display import PiTFTDisplay
-from utils import draw_histogram, overlay_histogram_on_image
+from utils import draw_histogram, overlay_histogram_on_image, parse_bracket, FocusAssist
 import tifffile
 
 import time
@@ -24,9 +24,23 @@ def main():
     parser.add_argument('--gain', type=float, default=None, help='Gain value (e.g. 1.0, 4.0, 16.0)')
     parser.add_argument('--etime', type=int, default=None, help='Exposure time in microseconds')
     parser.add_argument('--unpack-tiff', action='store_true', help='Unpack RAW12 and save as TIFF instead of .npy')
+    parser.add_argument('--bracket', type=parse_bracket, default=None,
+        help='Exposure bracket as comma-separated ETIME:GAIN steps (e.g. 5000:1.0,10000:1.0,20000:2.0)')
+    parser.add_argument('--focus-assist', action='store_true', help='Show focus peaking and sharpness meter on the preview')
+    parser.add_argument('--focus-magnify', action='store_true', help='Show a 1:1 centre crop of the raw stream in the preview (implies --focus-assist)')
+    parser.add_argument('--serve', action='store_true', help='Run the HTTP preview/control server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Preview server bind address (use 0.0.0.0 for LAN access, ideally with --token)')
+    parser.add_argument('--port', type=int, default=8000, help='Preview server port')
+    parser.add_argument('--token', type=str, default=None, help='Require this token (?token=... or X-Token header) on preview server requests')
     args = parser.parse_args()
 
-    cam_manager = CameraManager(camera_indices=[0], exposure_mode=args.mode, gain=args.gain, exposure_time=args.etime)
+    brackets = args.bracket
+    if brackets:
+        print(f"[INFO] Bracketing enabled: {brackets}")
+
+    cam_manager = CameraManager(camera_indices=[0], exposure_mode=args.mode, gain=args.gain, exposure_time=args.etime,
+                                preview_raw=args.focus_magnify)
+    focus_assist = FocusAssist() if (args.focus_assist or args.focus_magnify) else None
     display = PiTFTDisplay()
 
     # Setup buttons (redundant if using display.buttonA/B, but explicit here)
@@ -74,8 +88,45 @@ def main():
         "running": True,  # global running flag for all threads
         "camera_running": True,  # camera thread running flag
         "last_camera_activity": time.time(),
+        "capture_stats": {"frames": 0, "last_capture_ms": 0.0, "fps": 0.0},
     }
 
+    server = None
+    if args.serve:
+        from server import PreviewServer
+        server = PreviewServer(shared, event_queue, host=args.host, port=args.port, token=args.token)
+        if not server.start():
+            print("[WARN] Preview server failed to start; continuing without it.")
+            server = None
+
+    def save_raw(raw, now, suffix=""):
+        ms = int(now.microsecond / 1000)
+        if args.unpack_tiff:
+            img_name = f"IMG_{now.strftime('%Y%m%d_%H%M%S')}_{ms:03d}{suffix}.tiff"
+            img_path = os.path.join(shared["capture_dir"], img_name)
+            tifffile.imwrite(
+                img_path,
+                raw,
+                photometric='minisblack',
+                planarconfig='contig',
+                dtype='uint16'
+            )
+            print(f"[CAPTURE] Saved packed 12-bit TIFF to {img_path}")
+        else:
+            img_name = f"IMG_{now.strftime('%Y%m%d_%H%M%S')}_{ms:03d}{suffix}.npy"
+            img_path = os.path.join(shared["capture_dir"], img_name)
+            np.save(img_path, raw)
+            print(f"[CAPTURE] Saved RAW to {img_path}")
+        shared["img_count"] += 1
+
+    def update_capture_stats(t0, frames=1):
+        stats = shared["capture_stats"]
+        elapsed = time.time() - t0
+        stats["frames"] += frames
+        stats["last_capture_ms"] = round(elapsed * 1000, 2)
+        if elapsed > 0:
+            stats["fps"] = round(0.8 * stats["fps"] + 0.2 * (frames / elapsed), 2)
+
     def button_thread():
         last_a = buttonA.value
         last_b = buttonB.value
@@ -120,11 +171,20 @@ def main():
                         turn_off()
                         continue
                     # Use preview mode for fast preview
-                    frame = cam_manager.capture_frame()
+                    crop_ms = 0.0
+                    if args.focus_magnify:
+                        frame, crop = cam_manager.capture_preview_with_crop()
+                        crop_ms = cam_manager.last_crop_ms
+                    else:
+                        frame, crop = cam_manager.capture_frame(), None
                     if frame is not None:
+                        if focus_assist is not None:
+                            frame = focus_assist.process(frame, crop, extra_ms=crop_ms)
                         hist_img = draw_histogram(frame)
                         frame_with_hist = overlay_histogram_on_image(frame, hist_img, position=(5, 5))
                         display.show_image(frame_with_hist)
+                        if server is not None:
+                            server.publish(frame_with_hist)
                     time.sleep(0.05)
 
                 elif shared["state"] == STATE_CAPTURING:
@@ -133,27 +193,28 @@ def main():
                         turn_idle()
                         continue
                     # Button A does nothing (keep capturing)
-                    raw = cam_manager.capture_frame(raw=True)
-                    if raw is not None:
+                    t0 = time.time()
+                    if brackets:
+                        results = cam_manager.capture_bracket(brackets)
                         now = datetime.now()
-                        ms = int(now.microsecond / 1000)
-                        if args.unpack_tiff:
-                            img_name = f"IMG_{now.strftime('%Y%m%d_%H%M%S')}_{ms:03d}.tiff"
-                            img_path = os.path.join(shared["capture_dir"], img_name)
-                            tifffile.imwrite(
-                                img_path,
-                                raw,
-                                photometric='minisblack',
-                                planarconfig='contig',
-                                dtype='uint16'
-                            )
-                            print(f"[CAPTURE] Saved packed 12-bit TIFF to {img_path}")
-                        else:
-                            img_name = f"IMG_{now.strftime('%Y%m%d_%H%M%S')}_{ms:03d}.npy"
-                            img_path = os.path.join(shared["capture_dir"], img_name)
-                            np.save(img_path, raw)
-                            print(f"[CAPTURE] Saved RAW to {img_path}")
-                        shared["img_count"] += 1
+                        saved = 0
+                        for i, result in enumerate(results or []):
+                            if result is not None:
+                                raw, applied = result
+                                suffix = f"_B{i}"
+                                if applied["ExposureTime"] is not None:
+                                    suffix += f"_E{applied['ExposureTime']}"
+                                if applied["AnalogueGain"] is not None:
+                                    suffix += f"_G{applied['AnalogueGain']:.2f}"
+                                save_raw(raw, now, suffix)
+                                saved += 1
+                        if saved:
+                            update_capture_stats(t0, saved)
+                    else:
+                        raw = cam_manager.capture_frame(raw=True)
+                        if raw is not None:
+                            save_raw(raw, datetime.now())
+                            update_capture_stats(t0)
                     img = Image.new("RGB", (240, 240), (0, 0, 0))
                     draw = ImageDraw.Draw(img)
                     text = f"capturing - {shared['img_count']}"
@@ -210,6 +271,8 @@ def main():
         t2.join()
         print("Main cleanup complete.")
     finally:
+        if server is not None:
+            server.stop()
         print("Main finally.")
 
 if __name__ == "__main__":
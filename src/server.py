@@ -0,0 +1,295 @@
+import asyncio
+import hmac
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+
+BOUNDARY = "pisnapperframe"
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head><title>PiSnapper</title></head>
+<body style="background:#111;color:#eee;font-family:sans-serif">
+<img id="stream" width="480" height="480" style="image-rendering:pixelated"><br>
+<button onclick="fetch('/api/button/A' + q, {method:'POST'})">A</button>
+<button onclick="fetch('/api/button/B' + q, {method:'POST'})">B</button>
+<pre id="state"></pre>
+<script>
+// Pass ?token=... from the page URL on to every request
+var q = location.search;
+document.getElementById('stream').src = '/stream.mjpg' + q;
+setInterval(function() {
+  fetch('/api/state' + q).then(r => r.json()).then(s => {
+    document.getElementById('state').textContent = JSON.stringify(s, null, 2);
+  });
+}, 1000);
+</script>
+</body>
+</html>
+"""
+
+
+class PreviewServer:
+    """
+    Asyncio HTTP server for remote preview and control, run on its own thread.
+    The camera thread hands frames to publish(), which only stores a reference and
+    wakes the server loop; it never blocks on encoding or on clients. The server
+    encodes each new frame to JPEG once and fans the same bytes out to every MJPEG
+    client. Each client always jumps to the newest frame, so a slow client drops
+    frames instead of building a backlog.
+
+    Endpoints:
+      GET  /               - minimal HTML viewer
+      GET  /stream.mjpg    - MJPEG stream of the preview frames
+      GET  /api/state      - JSON: state, img_count, capture_dir, capture/server stats
+      POST /api/button/A   - same as pressing button A
+      POST /api/button/B   - same as pressing button B
+
+    If token is set, every request must carry it as ?token=... or an X-Token header.
+    POSTs whose Origin header names a different host are rejected, so a page on another
+    site can't press the buttons through the viewer's browser.
+    """
+
+    def __init__(self, shared, event_queue, host="127.0.0.1", port=8000, jpeg_quality=80, request_timeout=5.0,
+                 token=None):
+        self.shared = shared
+        self.event_queue = event_queue
+        self.host = host
+        self.port = port
+        self.jpeg_quality = jpeg_quality
+        self.request_timeout = request_timeout  # Seconds allowed to send the request line and headers
+        self.token = token
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+        self.running = False  # Set only once the server is listening
+        self._frame_lock = threading.Lock()
+        self._latest_frame = None
+        self._frame_ready = None
+        self._jpeg = None
+        self._jpeg_seq = 0
+        self._jpeg_cond = None
+        self.clients = 0
+        self.frames_published = 0
+        self.frames_encoded = 0
+        self.encode_ms = 0.0
+
+    # --- Called from other threads ---
+    def start(self):
+        """Start the server thread and wait until it is listening. Returns True on success."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait(timeout=5.0)
+        return self.running
+
+    def stop(self):
+        """Stop the server loop and wait for the thread to exit."""
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+
+    def publish(self, frame):
+        """Offer a new preview frame. Cheap and non-blocking; older unsent frames are dropped."""
+        with self._frame_lock:
+            self._latest_frame = frame
+        self.frames_published += 1
+        if not self.running:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._frame_ready.set)
+        except RuntimeError:
+            # Loop closed between the check and the call; the server is gone
+            pass
+
+    # --- Server thread ---
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._setup())
+            self.running = True
+            self._started.set()
+            print(f"[SERVER] Listening on http://{self.host}:{self.port}/")
+            self.loop.run_forever()
+        except Exception as e:
+            print(f"[ERROR] Preview server failed: {e}")
+        finally:
+            self.running = False
+            self._started.set()
+            if self._server is not None:
+                self._server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            # Let cancelled handlers run their cleanup before the loop goes away
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            if self._server is not None:
+                self.loop.run_until_complete(self._server.wait_closed())
+            self.loop.close()
+            print("[SERVER] Stopped.")
+
+    async def _setup(self):
+        self._frame_ready = asyncio.Event()
+        self._jpeg_cond = asyncio.Condition()
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+        self.loop.create_task(self._encoder())
+
+    async def _encoder(self):
+        """Encode the newest published frame once and wake every streaming client."""
+        while True:
+            await self._frame_ready.wait()
+            self._frame_ready.clear()
+            with self._frame_lock:
+                frame = self._latest_frame
+                self._latest_frame = None
+            if frame is None:
+                continue
+            if self.clients == 0:
+                # Nobody is watching; skip the encode entirely
+                continue
+            t0 = time.time()
+            ok, buf = await self.loop.run_in_executor(
+                None, cv2.imencode, ".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+            self.encode_ms = (time.time() - t0) * 1000
+            if not ok:
+                continue
+            async with self._jpeg_cond:
+                self._jpeg = buf.tobytes()
+                self._jpeg_seq += 1
+                self.frames_encoded += 1
+                self._jpeg_cond.notify_all()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                return
+            method = parts[0].upper()
+            url = urlsplit(parts[1])
+            path = url.path
+            headers = await asyncio.wait_for(self._read_headers(reader), self.request_timeout)
+            if not self._authorized(url, headers):
+                await self._send_json(writer, 403, {"error": "forbidden"})
+            elif method == "POST" and not self._same_origin(headers):
+                await self._send_json(writer, 403, {"error": "cross-origin request"})
+            elif method == "GET" and path == "/":
+                await self._send(writer, 200, "text/html; charset=utf-8", INDEX_HTML.encode())
+            elif method == "GET" and path == "/stream.mjpg":
+                await self._stream(reader, writer)
+            elif method == "GET" and path == "/api/state":
+                await self._send_json(writer, 200, self.status())
+            elif method == "POST" and path in ("/api/button/A", "/api/button/B"):
+                button = path.rsplit("/", 1)[1]
+                self.event_queue.put(button)
+                print(f"[SERVER] Remote button {button}")
+                await self._send_json(writer, 200, {"ok": True, "button": button})
+            else:
+                await self._send_json(writer, 404, {"error": "not found"})
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            # Server shutdown; finish normally so asyncio doesn't log the cancelled handler
+            pass
+        except Exception as e:
+            print(f"[WARN] Preview server request failed: {e}")
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_headers(self, reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    def _authorized(self, url, headers):
+        if not self.token:
+            return True
+        supplied = headers.get("x-token") or parse_qs(url.query).get("token", [""])[0]
+        return hmac.compare_digest(supplied.encode(), self.token.encode())
+
+    def _same_origin(self, headers):
+        origin = headers.get("origin")
+        if origin is None:
+            # Non-browser clients (curl, scripts) don't send Origin
+            return True
+        return urlsplit(origin).netloc == headers.get("host")
+
+    async def _send(self, writer, status, content_type, body):
+        reason = {200: "OK", 403: "Forbidden", 404: "Not Found"}.get(status, "")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Cache-Control: no-cache\r\n"
+            "Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, obj):
+        await self._send(writer, status, "application/json", json.dumps(obj).encode())
+
+    async def _stream(self, reader, writer):
+        writer.write(
+            "HTTP/1.1 200 OK\r\n"
+            f"Content-Type: multipart/x-mixed-replace; boundary={BOUNDARY}\r\n"
+            "Cache-Control: no-cache\r\n"
+            "Connection: close\r\n\r\n".encode())
+        await writer.drain()
+        self.clients += 1
+        # Race sending against the client hanging up, so a client that disconnects while
+        # no frames are coming (OFF/CAPTURING) is noticed and stops counting as a viewer
+        sender = asyncio.ensure_future(self._send_frames(writer))
+        hangup = asyncio.ensure_future(self._wait_eof(reader))
+        try:
+            await asyncio.wait({sender, hangup}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients -= 1
+            sender.cancel()
+            hangup.cancel()
+            await asyncio.gather(sender, hangup, return_exceptions=True)
+
+    async def _wait_eof(self, reader):
+        while await reader.read(1024):
+            pass
+
+    async def _send_frames(self, writer):
+        last_seq = 0
+        while True:
+            async with self._jpeg_cond:
+                await self._jpeg_cond.wait_for(lambda: self._jpeg_seq != last_seq)
+                jpeg, last_seq = self._jpeg, self._jpeg_seq
+            writer.write(
+                f"--{BOUNDARY}\r\n"
+                "Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b"\r\n")
+            # Only this client's coroutine waits here; frames encoded meanwhile are skipped
+            await writer.drain()
+
+    def status(self):
+        """Snapshot of app state and stats for /api/state."""
+        return {
+            "state": self.shared.get("state"),
+            "img_count": self.shared.get("img_count"),
+            "capture_dir": self.shared.get("capture_dir"),
+            "capture_stats": dict(self.shared.get("capture_stats", {})),
+            "server": {
+                "clients": self.clients,
+                "frames_published": self.frames_published,
+                "frames_encoded": self.frames_encoded,
+                "encode_ms": round(self.encode_ms, 2),
+            },
+        }
@@ -0,0 +1,174 @@
+import argparse
+import sys
+import types
+
+import numpy as np
+import pytest
+
+try:
+    import picamera2  # noqa: F401
+except ImportError:
+    stub = types.ModuleType("picamera2")
+    stub.Picamera2 = object
+    stub.MappedArray = object
+    sys.modules["picamera2"] = stub
+
+import camera
+from utils import parse_bracket
+
+
+class FakeRequest:
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.released = False
+
+    def get_metadata(self):
+        return dict(self.metadata)
+
+    def make_array(self, name):
+        return np.full((4, 8), self.metadata["Frame"], dtype=np.uint8)
+
+    def release(self):
+        self.released = True
+
+
+class FakeCamera:
+    """Applies controls `delay` sensor frames after the next one and can drop sensor frames."""
+
+    def __init__(self, idx=0, delay=2, drop=(), exposure=10000, gain=1.0):
+        self.delay = delay
+        self.drop = set(drop)
+        self.sensor_frame = 0
+        self.state = {"ExposureTime": exposure, "AnalogueGain": gain}
+        self.pending = []  # (apply_at_sensor_frame, controls)
+        self.sensor_resolution = (16, 8)
+        self.camera_properties = {}
+        self.controls = {}
+        self.camera_controls = {}
+
+    def create_video_configuration(self, **kwargs):
+        return kwargs
+
+    def create_still_configuration(self, **kwargs):
+        return kwargs
+
+    def configure(self, name):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def set_controls(self, controls):
+        self.pending.append((self.sensor_frame + 1 + self.delay, dict(controls)))
+
+    def _next_frame(self):
+        while True:
+            self.sensor_frame += 1
+            for apply_at, controls in [p for p in self.pending if p[0] <= self.sensor_frame]:
+                self.state.update({k: v for k, v in controls.items() if k in self.state})
+            self.pending = [p for p in self.pending if p[0] > self.sensor_frame]
+            if self.sensor_frame not in self.drop:
+                return dict(self.state, Frame=self.sensor_frame)
+
+    def capture_metadata(self):
+        return self._next_frame()
+
+    def capture_request(self):
+        return FakeRequest(self._next_frame())
+
+
+def make_manager(monkeypatch, **fake_kwargs):
+    monkeypatch.setattr(camera, "Picamera2", lambda idx: FakeCamera(idx, **fake_kwargs))
+    monkeypatch.setattr("time.sleep", lambda s: None)
+    return camera.CameraManager(camera_indices=[0])
+
+
+def applied(results):
+    return [(r[1]["ExposureTime"], r[1]["AnalogueGain"]) for r in results]
+
+
+def frame_numbers(results):
+    return [int(r[0][0, 0]) for r in results]
+
+
+def test_bracket_in_order(monkeypatch):
+    mgr = make_manager(monkeypatch)
+    brackets = [(5000, 1.0), (12000, 1.0), (20000, 2.0)]
+    results = mgr.capture_bracket(brackets)
+    assert applied(results) == brackets
+    assert frame_numbers(results) == sorted(frame_numbers(results))
+
+
+def test_bracket_dropped_frame_is_retried(monkeypatch):
+    # Controls for step 0 land on sensor frame 4 (capture_metadata uses frame 1)
+    mgr = make_manager(monkeypatch, drop={4})
+    brackets = [(5000, 1.0), (12000, 1.0), (20000, 2.0)]
+    results = mgr.capture_bracket(brackets)
+    assert None not in results
+    assert applied(results) == brackets
+
+
+def test_bracket_ignores_stale_frame(monkeypatch):
+    # Camera already sits at step 1's settings; frames exposed before step 0 must not fill it
+    mgr = make_manager(monkeypatch, delay=3)
+    brackets = [(5000, 1.0), (10000, 1.0)]
+    results = mgr.capture_bracket(brackets)
+    assert applied(results) == brackets
+    assert frame_numbers(results)[0] < frame_numbers(results)[1]
+
+
+def test_bracket_restores_exposure(monkeypatch):
+    mgr = make_manager(monkeypatch)
+    mgr.capture_bracket([(5000, 4.0)])
+    assert mgr.last_exposure[0] == 10000
+    assert mgr.last_gain[0] == 1.0
+
+
+def test_bracket_matches_tolerance():
+    mgr = camera.CameraManager.__new__(camera.CameraManager)
+    md = {"ExposureTime": 118, "AnalogueGain": 2.0}
+    # Line-time rounding on short exposures exceeds 5% but is within the absolute floor
+    assert mgr._bracket_matches(md, 2.0, 100, 0.05, 50)
+    assert not mgr._bracket_matches(md, 2.0, 100, 0.05, 10)
+    assert not mgr._bracket_matches(md, 4.0, 100, 0.05, 50)
+    assert mgr._bracket_matches({"ExposureTime": 10000}, None, 10000, 0.05, 50)
+
+
+def test_parse_bracket():
+    assert parse_bracket("5000:1.0,10000,:2") == [(5000, 1.0), (10000, None), (None, 2.0)]
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_bracket("10000:x")
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_bracket(":")
+
+
+class FakeMappedArray:
+    def __init__(self, req, name):
+        self.array = req.raw_buffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_preview_crop_is_centred_despite_stride_padding(monkeypatch):
+    mgr = make_manager(monkeypatch)
+    mgr.preview_raw = True
+    w, h = 64, 48
+    full = np.arange(h * w, dtype=np.uint16).reshape(h, w)
+    buf = np.zeros((h, w * 2 + 32), dtype=np.uint8)  # 16 pixels of stride padding
+    buf[:, :w * 2] = full.view(np.uint8)
+    cam = mgr.cameras[0]
+    cam.camera_configuration = lambda: {"raw": {"size": (w, h)}}
+    req = FakeRequest({"Frame": 1})
+    req.raw_buffer = buf
+    cam.capture_request = lambda: req
+    monkeypatch.setattr(camera, "MappedArray", FakeMappedArray)
+    _, crop = mgr.capture_preview_with_crop(crop_size=16)
+    assert (crop == full[16:32, 24:40]).all()
+    assert req.released
@@ -0,0 +1,164 @@
+import json
+import queue
+import socket
+import time
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+from server import PreviewServer, BOUNDARY
+
+
+@pytest.fixture
+def server():
+    shared = {"state": "idle", "img_count": 3, "capture_dir": None, "capture_stats": {"frames": 0}}
+    srv = PreviewServer(shared, queue.Queue(), host="127.0.0.1", port=0, request_timeout=0.5)
+    assert srv.start()
+    yield srv
+    srv.stop()
+
+
+def wait_for(cond, timeout=5.0):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.01)
+    return cond()
+
+
+def open_stream(server):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    sock.sendall(b"GET /stream.mjpg HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    return sock
+
+
+def read_jpeg(sock, server, value, timeout=5.0):
+    """Publish a flat frame of value until a JPEG part showing it arrives; return the decoded image."""
+    frame = np.full((240, 240, 3), value, dtype=np.uint8)
+    deadline = time.time() + timeout
+    data = b""
+    while time.time() < deadline:
+        server.publish(frame)
+        try:
+            data += sock.recv(1 << 20)
+        except socket.timeout:
+            break
+        # Decode the newest complete part; earlier parts may predate the published frame
+        end = data.rfind(b"\xff\xd9")
+        start = data.rfind(b"\xff\xd8", 0, end) if end >= 0 else -1
+        if start >= 0:
+            assert f"--{BOUNDARY}".encode() in data
+            img = cv2.imdecode(np.frombuffer(data[start:end + 2], dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            if img is not None and abs(int(img.mean()) - value) < 5:
+                return img
+            data = data[end + 2:]
+    return None
+
+
+def post(server, path, headers=None):
+    req = urllib.request.Request(f"http://127.0.0.1:{server.port}{path}", method="POST", headers=headers or {})
+    return urllib.request.urlopen(req)
+
+
+def test_state(server):
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/api/state") as resp:
+        state = json.load(resp)
+    assert state["state"] == "idle"
+    assert state["img_count"] == 3
+    assert "clients" in state["server"]
+
+
+def test_button(server):
+    with post(server, "/api/button/A") as resp:
+        assert json.load(resp) == {"ok": True, "button": "A"}
+    assert server.event_queue.get_nowait() == "A"
+
+
+def test_button_rejects_cross_origin(server):
+    with pytest.raises(urllib.error.HTTPError) as err:
+        post(server, "/api/button/A", {"Origin": "http://evil.example"})
+    assert err.value.code == 403
+    assert server.event_queue.empty()
+    with post(server, "/api/button/B", {"Origin": f"http://127.0.0.1:{server.port}"}):
+        pass
+    assert server.event_queue.get_nowait() == "B"
+
+
+def test_token_required():
+    srv = PreviewServer({}, queue.Queue(), host="127.0.0.1", port=0, token="s3cret")
+    assert srv.start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as err:
+            post(srv, "/api/button/A")
+        assert err.value.code == 403
+        with post(srv, "/api/button/A?token=s3cret"):
+            pass
+        with post(srv, "/api/button/B", {"X-Token": "s3cret"}):
+            pass
+        assert [srv.event_queue.get_nowait(), srv.event_queue.get_nowait()] == ["A", "B"]
+    finally:
+        srv.stop()
+
+
+def test_mjpeg_part(server):
+    sock = open_stream(server)
+    assert wait_for(lambda: server.clients == 1)
+    img = read_jpeg(sock, server, 200)
+    sock.close()
+    assert img is not None
+
+
+def test_disconnect_releases_client(server):
+    sock = open_stream(server)
+    assert wait_for(lambda: server.clients == 1)
+    # No frames are being published, so only the hang-up can wake the handler
+    sock.close()
+    assert wait_for(lambda: server.clients == 0)
+
+
+def test_slow_client_does_not_backpressure(server):
+    slow = open_stream(server)  # Never read from
+    assert wait_for(lambda: server.clients == 1)
+    rng = np.random.default_rng(0)
+    noise = (rng.random((240, 240, 3)) * 255).astype(np.uint8)  # Large JPEGs fill socket buffers fast
+    worst = 0.0
+    deadline = time.time() + 2.0
+    while time.time() < deadline:
+        t0 = time.perf_counter()
+        server.publish(noise)
+        worst = max(worst, time.perf_counter() - t0)
+        time.sleep(0.002)
+    assert server.frames_encoded > 10
+    assert worst < 0.05
+    # A second client still gets fresh frames
+    fast = open_stream(server)
+    assert wait_for(lambda: server.clients == 2)
+    assert read_jpeg(fast, server, 50) is not None
+    fast.close()
+    slow.close()
+
+
+def test_stop_with_stream_client(capfd):
+    srv = PreviewServer({}, queue.Queue(), host="127.0.0.1", port=0)
+    assert srv.start()
+    sock = open_stream(srv)
+    assert wait_for(lambda: srv.clients == 1)
+    srv.stop()
+    sock.close()
+    assert not srv._thread.is_alive()
+    assert "Traceback" not in capfd.readouterr().err
+
+
+def test_idle_client_times_out(server):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    # Server closes the connection once request_timeout passes without a request
+    assert sock.recv(1) == b""
+    sock.close()
+
+
+def test_port_in_use_fails_cleanly(server):
+    other = PreviewServer({}, queue.Queue(), host="127.0.0.1", port=server.port)
+    assert not other.start()
+    other.publish(np.zeros((240, 240, 3), dtype=np.uint8))  # must not raise
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+
+from utils import FocusAssist
+
+
+def scene():
+    rng = np.random.default_rng(0)
+    gray = (rng.random((240, 240)) * 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def test_sharp_scores_higher_than_blurred():
+    sharp = scene()
+    blurred = cv2.GaussianBlur(sharp, (9, 9), 3)
+    fa = FocusAssist()
+    fa.process(sharp.copy())
+    sharp_score = fa.score
+    fa.process(blurred.copy())
+    assert sharp_score > fa.score * 2
+    # Peak hold keeps the sharp reading
+    assert fa.peak > fa.score
+
+
+def test_score_independent_of_step():
+    fa = FocusAssist(step=2)
+    fa.process(scene())
+    score = fa.score
+    fa.step = fa.max_step
+    fa.process(scene())
+    assert fa.score == score
+
+
+def test_step_grows_when_over_budget():
+    fa = FocusAssist(budget_ms=0.0)
+    for _ in range(5):
+        fa.process(scene())
+    assert fa.step > fa.min_step
+
+
+def test_step_relaxes_with_headroom():
+    fa = FocusAssist(budget_ms=1000.0)
+    fa.step = fa.max_step
+    for _ in range(fa.max_step):
+        fa.process(scene())
+    assert fa.step == fa.min_step
+
+
+def test_crop_time_not_budgeted():
+    fa = FocusAssist(budget_ms=1000.0)
+    for _ in range(5):
+        fa.process(scene(), extra_ms=5000.0)
+    assert fa.step == fa.min_step
+    assert fa.crop_ms == 5000.0
+    assert fa.last_ms >= fa.crop_ms
+
+
+def test_magnified_crop_resets_peak():
+    fa = FocusAssist()
+    fa.process(scene())
+    assert fa.peak > 0
+    crop = np.zeros((240, 240), dtype=np.uint16)
+    out = fa.process(scene(), crop)
+    assert out.shape == (240, 240, 3)
+    assert fa.score == 0.0 and fa.peak == 0.0
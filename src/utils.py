@@ -1,3 +1,5 @@
+import argparse
+import time
 import cv2
 import numpy as np
 from PIL import Image
@@ -22,4 +24,147 @@ def overlay_histogram_on_image(frame, hist_img, position=(0, 0)):
     frame_pil = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
     hist_img = hist_img.convert("RGBA").resize((128, 50))
     frame_pil.paste(hist_img, position, hist_img)
-    return cv2.cvtColor(np.array(frame_pil), cv2.COLOR_RGB2BGR)
\ No newline at end of file
+    return cv2.cvtColor(np.array(frame_pil), cv2.COLOR_RGB2BGR)
+
+
+def parse_bracket(value):
+    """Parse --bracket 'ETIME:GAIN,...' into a list of (exposure_time_us, gain) tuples."""
+    brackets = []
+    for step in value.split(','):
+        etime, _, gain = step.strip().partition(':')
+        try:
+            brackets.append((int(etime) if etime else None, float(gain) if gain else None))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid bracket step '{step}', expected ETIME:GAIN (e.g. 10000:2.0)")
+        if brackets[-1] == (None, None):
+            raise argparse.ArgumentTypeError(f"bracket step '{step}' sets neither exposure nor gain")
+    return brackets
+
+
+class FocusAssist:
+    """
+    Focus-peaking overlay and sharpness meter for the live preview.
+    The sharpness score is the mean absolute Laplacian over a fixed centre region at a
+    fixed sampling step, so readings stay comparable and the peak hold is meaningful.
+    The peaking overlay runs a Laplacian on a subsampled copy of the whole frame and
+    paints strong edges in the peaking colour. Scratch buffers are allocated once per
+    input size and reused every frame.
+    The overlay cost is timed; if it exceeds budget_ms the overlay subsampling step is
+    increased (and relaxed again once there is headroom) so preview fps is not reduced.
+    Capture-side crop time (extra_ms) can't be reduced by the step, so it is reported
+    in crop_ms/last_ms but not fed into the adaptation.
+    """
+
+    def __init__(self, budget_ms=4.0, step=2, max_step=8, score_size=96, score_step=1,
+                 edge_threshold=48, peak_decay=0.98, color=(0, 0, 255)):
+        self.budget_ms = budget_ms
+        self.min_step = step
+        self.step = step
+        self.max_step = max_step
+        self.score_size = score_size
+        self.score_step = score_step
+        self.edge_threshold = edge_threshold
+        self.peak_decay = peak_decay
+        self.color = np.array(color, dtype=np.uint8)
+        self.score = 0.0
+        self.peak = 0.0
+        self.last_ms = 0.0  # Total focus-assist cost of the last frame, crop included
+        self.overlay_ms = 0.0  # Cost of the last frame excluding the crop
+        self.crop_ms = 0.0  # Capture-side crop time of the last frame
+        self.avg_ms = 0.0  # Moving average of overlay_ms, used to pick the step
+        self._magnified = None
+        self._shape = None
+        self._gray = None
+        self._lap = None
+        self._mask = None
+        self._score_shape = None
+        self._score_gray = None
+        self._score_lap = None
+        self._crop8 = None
+        self._view = None
+
+    def _alloc(self, shape):
+        """(Re)allocate overlay scratch buffers for a subsampled region of the given shape."""
+        self._shape = shape
+        self._gray = np.empty(shape, dtype=np.uint8)
+        self._lap = np.empty(shape, dtype=np.int16)
+        self._mask = np.empty(shape, dtype=bool)
+
+    def _alloc_score(self, shape):
+        """(Re)allocate scoring scratch buffers; a new region means old readings no longer compare."""
+        self._score_shape = shape
+        self._score_gray = np.empty(shape, dtype=np.uint8)
+        self._score_lap = np.empty(shape, dtype=np.int16)
+        self.peak = 0.0
+
+    def _adapt_step(self):
+        """Bound per-frame cost by trading overlay resolution for time."""
+        if self.avg_ms > self.budget_ms and self.step < self.max_step:
+            self.step += 1
+        elif self.avg_ms < self.budget_ms * 0.3 and self.step > self.min_step:
+            self.step -= 1
+
+    def _update_score(self, gray):
+        """Score the fixed centre region of a 2D uint8 image at the fixed score step."""
+        h, w = gray.shape
+        size = min(self.score_size * self.score_step, h, w)
+        y0 = (h - size) // 2
+        x0 = (w - size) // 2
+        region = gray[y0:y0 + size:self.score_step, x0:x0 + size:self.score_step]
+        if region.shape != self._score_shape:
+            self._alloc_score(region.shape)
+        np.copyto(self._score_gray, region)
+        cv2.Laplacian(self._score_gray, cv2.CV_16S, dst=self._score_lap, ksize=1)
+        np.abs(self._score_lap, out=self._score_lap)
+        self.score = float(self._score_lap.mean())
+        self.peak = max(self.score, self.peak * self.peak_decay)
+
+    def process(self, frame, crop=None, extra_ms=0.0):
+        """
+        Apply focus assist and return the frame to display.
+        frame is the 240x240 3-channel preview (modified in place).
+        crop, if given, is a 2D single-plane centre crop from the raw stream (uint8 or
+        12-bit uint16); it is scored at native resolution and shown magnified in place
+        of the preview.
+        extra_ms is time already spent producing the crop; it is reported, not budgeted.
+        """
+        t0 = time.perf_counter()
+        magnified = crop is not None
+        if magnified != self._magnified:
+            # Switching score source; readings from the other source do not compare
+            self._magnified = magnified
+            self.peak = 0.0
+        if magnified:
+            if crop.dtype != np.uint8:
+                if self._crop8 is None or self._crop8.shape != crop.shape:
+                    self._crop8 = np.empty(crop.shape, dtype=np.uint8)
+                np.right_shift(crop, 4, out=self._crop8, casting='unsafe')
+                crop = self._crop8
+            self._update_score(crop)
+            if self._view is None or self._view.shape != frame.shape:
+                self._view = np.empty(frame.shape, dtype=np.uint8)
+            small = cv2.resize(crop, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+            cv2.cvtColor(small, cv2.COLOR_GRAY2BGR, dst=self._view)
+            frame = self._view
+        else:
+            # Green channel is a cheap luminance proxy
+            self._update_score(frame[..., 1])
+        step = self.step
+        # The strided view avoids a full-frame copy
+        sub = frame[::step, ::step]
+        if sub.shape[:2] != self._shape:
+            self._alloc(sub.shape[:2])
+        np.copyto(self._gray, sub[..., 1])
+        cv2.Laplacian(self._gray, cv2.CV_16S, dst=self._lap, ksize=1)
+        np.abs(self._lap, out=self._lap)
+        threshold = max(self.edge_threshold, int(self._lap.max()) // 2)
+        np.greater(self._lap, threshold, out=self._mask)
+        sub[self._mask] = self.color
+        cv2.putText(frame, f"F {self.score:5.1f} PK {self.peak:5.1f}", (5, frame.shape[0] - 8),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        self.overlay_ms = (time.perf_counter() - t0) * 1000
+        self.crop_ms = extra_ms
+        self.last_ms = self.overlay_ms + extra_ms
+        self.avg_ms = 0.9 * self.avg_ms + 0.1 * self.overlay_ms
+        self._adapt_step()
+        return frame